@@ -0,0 +1,344 @@
+"""Time and peak memory of the statement parsing and aggregation hot paths
+
+Benchmarks, on synthetic statements of each size:
+
+- parse-redact: parseStatementCSV, masking with the MASKED redaction plan
+  and rows(), as done by get_statement_range_CSV
+- cashflow: calculateCashflow without the statement
+- statement-json: statementCSVtoJson
+
+The run fails when any benchmark is slower, or peaks higher, than the
+baseline by more than --threshold (--large-threshold for statements over
+10000 rows, which are timed fewer times). The baseline is either another
+git ref, benchmarked in the same run on the same machine, or results stored
+earlier:
+
+    python benchmarks/bench_hotpaths.py --against master
+    python benchmarks/bench_hotpaths.py --update-baseline  # on master
+    python benchmarks/bench_hotpaths.py                    # on a change
+"""
+import argparse
+import inspect
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(
+    os.path.dirname(__file__), "baseline_hotpaths.json"
+)
+
+main = None
+
+
+class BenchmarkError(Exception):
+    """The benchmarks can't be run against the requested code"""
+
+
+def load_app(app_dir):
+    """Import main.py from app_dir, without real caches or credentials"""
+    global main
+    os.environ.setdefault("STATEMENT_CACHE_PATH", ":memory:")
+    os.environ.setdefault("BANK_ACCOUNT_ID", "bench-account")
+    os.environ.setdefault("PERSONAL_ACCESS_TOKEN", "bench-token")
+    sys.path.insert(0, app_dir)
+    import main
+
+
+def missing_api():
+    """Names the benchmarks use which the loaded main.py lacks"""
+    missing = [
+        name
+        for name in (
+            "STATEMENT_HEADER",
+            "MASKED",
+            "Statement",
+            "parseStatementCSV",
+            "pence_to_str",
+            "calculateCashflow",
+            "statementCSVtoJson",
+        )
+        if not hasattr(main, name)
+    ]
+    if hasattr(main, "calculateCashflow"):
+        parameters = inspect.signature(main.calculateCashflow).parameters
+        if "include" not in parameters:
+            missing.append("calculateCashflow(include=)")
+    return missing
+
+
+def synthetic_statement_csv(rows, seed=0):
+    rng = random.Random(seed)
+    lines = [",".join(main.STATEMENT_HEADER)]
+    day = date(2020, 1, 1)
+    balance = 1000000
+    for i in range(rows):
+        if i % 50 == 0:
+            day += timedelta(days=1)
+        pence = rng.randint(-250000, 250000)
+        balance += pence
+        lines.append(
+            ",".join(
+                [
+                    day.strftime("%d/%m/%Y"),
+                    f"Counterparty {rng.randint(1, 200)}",
+                    f'"REF {rng.randint(1000, 9999)}, invoice"',
+                    "FASTER PAYMENT",
+                    main.pence_to_str(pence),
+                    main.pence_to_str(balance),
+                    rng.choice(["INCOME", "BILLS_AND_SERVICES", "GENERAL"]),
+                    "",
+                ]
+            )
+        )
+    return "\r\n".join(lines) + "\r\n"
+
+
+def parse_redact(body, _):
+    statement = main.parseStatementCSV(body)
+    return main.MASKED.apply(statement).rows()
+
+
+def cashflow(_, statement):
+    # A fresh Statement so the memoised columns are rebuilt every run
+    fresh = main.Statement(statement.header, statement.transactions)
+    return main.calculateCashflow(fresh, include=frozenset())
+
+
+def statement_json(_, statement):
+    return main.statementCSVtoJson(statement)
+
+
+BENCHMARKS = {
+    "parse-redact": parse_redact,
+    "cashflow": cashflow,
+    "statement-json": statement_json,
+}
+
+
+def measure(benchmark, body, statement, repeat, min_time=0.2):
+    """Best time per run of repeat samples, then peak memory of one more run
+
+    Each sample runs the benchmark until at least min_time has passed, so
+    fast benchmarks aren't dominated by timer and scheduling noise.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        runs = 0
+        start = time.perf_counter()
+        while True:
+            benchmark(body, statement)
+            runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / runs)
+
+    tracemalloc.start()
+    benchmark(body, statement)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": best, "peak_bytes": peak}
+
+
+def compare(results, baseline, threshold, large_threshold):
+    """Descriptions of every result worse than baseline beyond threshold"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        size = int(name.rpartition("/")[2])
+        allowed = threshold if size <= 10000 else large_threshold
+        for metric in ("seconds", "peak_bytes"):
+            if result[metric] > base[metric] * (1 + allowed):
+                growth = result[metric] / base[metric] - 1
+                regressions.append(
+                    f"{name} {metric}: {result[metric]:.6g} vs baseline "
+                    f"{base[metric]:.6g} (+{growth:.0%})"
+                )
+    return regressions
+
+
+def benchmark_in_subprocess(app_dir, args):
+    """Results of this script run on app_dir's main.py in a fresh process"""
+    with tempfile.TemporaryDirectory() as tmp:
+        results_path = os.path.join(tmp, "results.json")
+        completed = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--app-dir",
+                app_dir,
+                "--sizes",
+                *map(str, args.sizes),
+                "--repeat",
+                str(args.repeat),
+                "--large-repeat",
+                str(args.large_repeat),
+                "--baseline",
+                results_path,
+                "--update-baseline",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        if completed.returncode != 0:
+            raise BenchmarkError(f"Benchmarking {app_dir} failed")
+        with open(results_path) as fp:
+            return json.load(fp)
+
+
+def best_of(results, more):
+    """Lowest time and peak of each benchmark across two sets of results"""
+    if results is None:
+        return more
+    return {
+        name: {
+            metric: min(result[metric], more[name][metric])
+            for metric in ("seconds", "peak_bytes")
+        }
+        for name, result in results.items()
+    }
+
+
+def compare_with_ref(ref, args):
+    """Results of ref's main.py then of the working tree's, best of rounds
+
+    The two alternate so drift in machine load affects both alike.
+    """
+    with tempfile.TemporaryDirectory() as ref_dir:
+        archive = subprocess.run(
+            ["git", "archive", ref, "main.py"],
+            cwd=REPO_DIR,
+            stdout=subprocess.PIPE,
+        )
+        if archive.returncode != 0:
+            raise BenchmarkError(f"Can't read main.py from git ref {ref}")
+        with tarfile.open(fileobj=io.BytesIO(archive.stdout)) as tar:
+            tar.extractall(ref_dir)
+        baseline = results = None
+        for i in range(args.rounds):
+            print(f"Round {i + 1} of {args.rounds}")
+            try:
+                ref_results = benchmark_in_subprocess(ref_dir, args)
+            except BenchmarkError:
+                raise BenchmarkError(f"Can't benchmark git ref {ref}")
+            baseline = best_of(baseline, ref_results)
+            tree_results = benchmark_in_subprocess(args.app_dir, args)
+            results = best_of(results, tree_results)
+    return baseline, results
+
+
+def report(results):
+    for key, result in results.items():
+        print(
+            f"{key:24} {result['seconds'] * 1000:10.2f} ms"
+            f"  peak {result['peak_bytes'] / 2**20:8.2f} MiB"
+        )
+
+
+def run(args):
+    if args.against:
+        try:
+            baseline, results = compare_with_ref(args.against, args)
+        except BenchmarkError as e:
+            print(e, file=sys.stderr)
+            return 2
+        print(f"{args.against}:")
+        report(baseline)
+        print("Working tree:")
+        report(results)
+        return check(results, baseline, args)
+
+    load_app(args.app_dir)
+    missing = missing_api()
+    if missing:
+        print(
+            f"{os.path.join(args.app_dir, 'main.py')} has no"
+            f" {', '.join(missing)}, which the benchmarks use",
+            file=sys.stderr,
+        )
+        return 2
+    results = {}
+    for size in args.sizes:
+        body = synthetic_statement_csv(size)
+        statement = main.parseStatementCSV(body)
+        repeat = args.repeat if size <= 10000 else args.large_repeat
+        for name, benchmark in BENCHMARKS.items():
+            key = f"{name}/{size}"
+            results[key] = measure(benchmark, body, statement, repeat)
+            report({key: results[key]})
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(
+            f"No baseline at {args.baseline}, run with --update-baseline"
+            " or compare --against a git ref"
+        )
+        return 2
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    return check(results, baseline, args)
+
+
+def check(results, baseline, args):
+    regressions = compare(
+        results, baseline, args.threshold, args.large_threshold
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="*", default=[1000, 100000, 1000000]
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Timed runs of small statements"
+    )
+    parser.add_argument(
+        "--large-repeat",
+        type=int,
+        default=3,
+        help="Timed runs of statements over 10000 rows",
+    )
+    parser.add_argument(
+        "--against", help="Git ref to benchmark as the baseline in this run"
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=3,
+        help="Alternating runs of the ref and the working tree with --against",
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.3,
+        help="Allowed slowdown or memory growth over baseline, 0.3 is 30%%",
+    )
+    parser.add_argument(
+        "--large-threshold",
+        type=float,
+        default=0.5,
+        help="--threshold for statements over 10000 rows",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--app-dir", default=REPO_DIR, help=argparse.SUPPRESS)
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,162 @@
+"""End to end throughput and latency of every route under concurrent load
+
+Run the app against the mock Starling API (see mock_starling.py), then:
+
+    python benchmarks/bench_routes.py --base-url http://127.0.0.1:8000 \
+        --requests 200 --concurrency 20 --output bench_routes.json
+
+Results are written as JSON, one entry per route, for comparing runs.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import time
+from datetime import date, timedelta
+
+import httpx
+
+
+def routes():
+    """(name, path, params) of every route worth benchmarking"""
+    last_month_end = date.today().replace(day=1) - timedelta(days=1)
+    last_month_start = last_month_end.replace(day=1)
+    year_ago = date.today() - timedelta(days=365)
+    return [
+        ("balance", "/", {}),
+        ("available-periods", "/statement/available-periods", {}),
+        (
+            "statement",
+            "/statement/downloadForDateRange",
+            {
+                "startDate": last_month_start.isoformat(),
+                "endDate": last_month_end.isoformat(),
+            },
+        ),
+        (
+            "statement-stream",
+            "/statement/downloadForDateRange/stream",
+            {
+                "startDate": last_month_start.isoformat(),
+                "endDate": last_month_end.isoformat(),
+            },
+        ),
+        ("cashflow-this-month", "/cashflow-this-month", {}),
+        ("cashflow-last-month", "/cashflow-last-month", {}),
+        (
+            "cashflow-by-month",
+            "/cashflow-by-month",
+            {"startDate": last_month_start.isoformat()},
+        ),
+        (
+            "cashflow-last-12-months",
+            "/cashflow-last-n-months",
+            {"number_of_months": 12},
+        ),
+        (
+            "cashflow-last-12-months-totals",
+            "/cashflow-last-n-months",
+            {"number_of_months": 12, "include": "", "single_fetch": "true"},
+        ),
+        (
+            "cashflow-buckets-weekly",
+            "/cashflow/buckets",
+            {
+                "start": year_ago.isoformat(),
+                "end": last_month_end.isoformat(),
+                "granularity": "weekly",
+            },
+        ),
+        (
+            "cashflow-categories",
+            "/cashflow/categories",
+            {"start": year_ago.isoformat(), "end": last_month_end.isoformat()},
+        ),
+    ]
+
+
+def percentile(latencies, p):
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def bench_route(client, path, params, requests, concurrency):
+    latencies = []
+    errors = 0
+    bytes_received = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors, bytes_received
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                resp = await client.get(path, params=params)
+                bytes_received += len(resp.content)
+                if resp.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "throughput_rps": requests / elapsed,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "latency_mean_ms": statistics.mean(latencies) * 1000,
+        "bytes_per_response": bytes_received / requests,
+    }
+
+
+async def main(args):
+    results = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "base_url": args.base_url,
+        "routes": {},
+    }
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=args.base_url, limits=limits, timeout=args.timeout
+    ) as client:
+        for name, path, params in routes():
+            if args.only and name not in args.only:
+                continue
+            # One untimed request so every route starts equally warm
+            await client.get(path, params=params)
+            result = await bench_route(
+                client, path, params, args.requests, args.concurrency
+            )
+            results["routes"][name] = result
+            print(
+                f"{name:32} {result['throughput_rps']:8.1f} req/s"
+                f"  p50 {result['latency_p50_ms']:8.1f} ms"
+                f"  p99 {result['latency_p99_ms']:8.1f} ms"
+                f"  errors {result['errors']}"
+            )
+
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", default="bench_routes.json")
+    parser.add_argument(
+        "--only", nargs="*", help="Only benchmark these route names"
+    )
+    asyncio.run(main(parser.parse_args()))
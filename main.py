@@ -1,29 +1,690 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders, QueryParams
+import asyncio
+import brotli
+import httpx
 from dotenv import load_dotenv
 import logging
 import os
 from babel.numbers import format_currency
 import io
 import csv
+import fcntl
+import json
+import orjson
+import pytz
+import gzip
+import hashlib
+import hmac
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import date, timedelta, datetime
+from decimal import Decimal
+from enum import Enum
 import calendar
+import numpy as np
+from collections import OrderedDict
+from itertools import islice, repeat, starmap
+from operator import attrgetter
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from types import MappingProxyType
 from typing import Optional
 
 log = logging.getLogger()
 
+# Read by prometheus_client as it's imported, so it can't come from .env
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
 load_dotenv(verbose=True)
 
 log.setLevel(os.getenv("PYTHON_LOGLEVEL", logging.DEBUG))
 
 PERSONAL_ACCESS_TOKEN = os.getenv("PERSONAL_ACCESS_TOKEN")
+DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD = os.getenv(
+    "DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD"
+)
 BANK_ACCOUNT_ID = os.getenv("BANK_ACCOUNT_ID")
 
-headers = {
-    "Authorization": PERSONAL_ACCESS_TOKEN,
-    "accept": "application/json",
-}
+STARLING_API_URL = os.getenv(
+    "STARLING_API_URL", "https://api.starlingbank.com"
+)
+STARLING_POOL_SIZE = int(os.getenv("STARLING_POOL_SIZE", 10))
+STARLING_MAX_CONNECTIONS = int(os.getenv("STARLING_MAX_CONNECTIONS", 100))
+STARLING_CONNECT_TIMEOUT = float(os.getenv("STARLING_CONNECT_TIMEOUT", 5))
+STARLING_READ_TIMEOUT = float(os.getenv("STARLING_READ_TIMEOUT", 30))
+CASHFLOW_MAX_CONCURRENCY = int(os.getenv("CASHFLOW_MAX_CONCURRENCY", 6))
+STATEMENT_CACHE_PATH = os.getenv("STATEMENT_CACHE_PATH", "statement_cache.db")
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", 10))
+STATEMENT_MEMORY_CACHE_SIZE = int(os.getenv("STATEMENT_MEMORY_CACHE_SIZE", 64))
+LEDGER_ENABLED = os.getenv("LEDGER_ENABLED", "false").lower() == "true"
+LEDGER_PATH = os.getenv("LEDGER_PATH", "ledger.db")
+LEDGER_SYNC_INTERVAL = float(os.getenv("LEDGER_SYNC_INTERVAL", 60))
+LEDGER_SYNC_FROM = os.getenv("LEDGER_SYNC_FROM", "2000-01-01T00:00:00.000Z")
+BANK_CATEGORY_ID = os.getenv("BANK_CATEGORY_ID")
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", "scheduler.lock")
+PREFETCH_BALANCE_INTERVAL = float(os.getenv("PREFETCH_BALANCE_INTERVAL", 30))
+PREFETCH_STATEMENT_INTERVAL = float(
+    os.getenv("PREFETCH_STATEMENT_INTERVAL", 300)
+)
+PREFETCH_PERIODS_INTERVAL = float(os.getenv("PREFETCH_PERIODS_INTERVAL", 3600))
+PREFETCH_SUMMARIES_INTERVAL = float(
+    os.getenv("PREFETCH_SUMMARIES_INTERVAL", 300)
+)
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", 1))
+ORJSON_ENABLED = os.getenv("ORJSON_ENABLED", "false").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_CACHE_SIZE = int(os.getenv("COMPRESSION_CACHE_SIZE", 64))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.001))
+
+REQUEST_LATENCY = Histogram(
+    "balance_request_duration_seconds",
+    "Time to answer a request, by route",
+    ["method", "route"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "balance_requests_in_progress",
+    "Requests currently being answered",
+    multiprocess_mode="livesum",
+)
+UPSTREAM_LATENCY = Histogram(
+    "balance_upstream_duration_seconds",
+    "Time for Starling to respond, by API path",
+    ["path"],
+)
+UPSTREAM_RESPONSES = Counter(
+    "balance_upstream_responses_total",
+    "Starling responses, by API path and status code",
+    ["path", "status"],
+)
+UPSTREAM_BYTES = Counter(
+    "balance_upstream_bytes_total",
+    "Bytes downloaded from Starling, by API path",
+    ["path"],
+)
+UPSTREAM_IN_PROGRESS = Gauge(
+    "balance_upstream_requests_in_progress",
+    "Starling requests currently awaiting a response",
+    multiprocess_mode="livesum",
+)
+ROWS_PARSED = Counter(
+    "balance_statement_rows_parsed_total", "Statement rows parsed"
+)
+CACHE_REQUESTS = Counter(
+    "balance_cache_requests_total",
+    "Cache lookups, by cache and whether they hit",
+    ["cache", "result"],
+)
+EVENT_LOOP_LAG = Gauge(
+    "balance_event_loop_lag_seconds",
+    "Delay before a ready task gets to run on the event loop",
+    multiprocess_mode="liveall",
+)
+THREADS = Gauge(
+    "balance_threads",
+    "Threads alive in the process",
+    multiprocess_mode="liveall",
+)
+
+
+def upstream_path_label(path):
+    """API path with account and category ids templated out"""
+    templates = {
+        BANK_ACCOUNT_ID: "{accountUid}",
+        BANK_CATEGORY_ID: "{categoryUid}",
+    }
+    return "/".join(
+        templates.get(segment, segment) for segment in path.split("/")
+    )
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+# Seconds spent per phase of the current request, set by add_server_timing
+REQUEST_PHASES = ContextVar("REQUEST_PHASES", default=None)
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to the current request's phase
+
+    Concurrent blocks of the same phase (such as months fetched together)
+    are summed, so a phase can exceed the request's total time.
+    """
+    phases = REQUEST_PHASES.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + time.perf_counter() - start
+
+
+# Set per request by CompressionMiddleware, see cache_compressed
+RESPONSE_COMPRESSION = ContextVar("RESPONSE_COMPRESSION", default=None)
+
+
+def cache_compressed():
+    """Let the current response's compressed body be cached
+
+    For routes whose body can't change, such as closed periods, so repeat
+    requests aren't compressed again.
+    """
+    compression = RESPONSE_COMPRESSION.get()
+    if compression is not None:
+        compression["cacheable"] = True
+
+
+# Read-only, each request builds its own headers from these
+BASE_HEADERS = MappingProxyType({"Authorization": PERSONAL_ACCESS_TOKEN})
+
+
+def request_headers(accept="application/json"):
+    return {**BASE_HEADERS, "accept": accept}
+
+
+class StarlingError(Exception):
+    """Starling responded with something other than a success"""
+
+
+class AsyncStarlingClient:
+    """Non-blocking, pooled connection to the Starling API.
+
+    One instance is shared by every endpoint, so a single worker can hold
+    many in-flight upstream calls without tying up a thread for each.
+    """
+
+    def __init__(
+        self,
+        base_url=STARLING_API_URL,
+        pool_size=STARLING_POOL_SIZE,
+        max_connections=STARLING_MAX_CONNECTIONS,
+        connect_timeout=STARLING_CONNECT_TIMEOUT,
+        read_timeout=STARLING_READ_TIMEOUT,
+    ):
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=pool_size,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+    async def get(self, path, accept="application/json", params=None):
+        label = upstream_path_label(path)
+        with timed("upstream"), UPSTREAM_IN_PROGRESS.track_inprogress(), UPSTREAM_LATENCY.labels(  # noqa: E501
+            label
+        ).time():
+            req = await self.client.get(
+                path, headers=request_headers(accept), params=params
+            )
+        UPSTREAM_RESPONSES.labels(label, req.status_code).inc()
+        UPSTREAM_BYTES.labels(label).inc(len(req.content))
+        return req
+
+    async def stream(self, path, accept="application/json", params=None):
+        """Response whose body is read incrementally, caller must aclose()
+
+        The bytes read are counted by record_stream_bytes once it's closed.
+        """
+        label = upstream_path_label(path)
+        request = self.client.build_request(
+            "GET", path, headers=request_headers(accept), params=params
+        )
+        with timed("upstream"), UPSTREAM_IN_PROGRESS.track_inprogress(), UPSTREAM_LATENCY.labels(  # noqa: E501
+            label
+        ).time():
+            req = await self.client.send(request, stream=True)
+        UPSTREAM_RESPONSES.labels(label, req.status_code).inc()
+        return req
+
+    @staticmethod
+    def record_stream_bytes(path, req):
+        UPSTREAM_BYTES.labels(upstream_path_label(path)).inc(
+            req.num_bytes_downloaded
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class StatementCache:
+    """On-disk store of downloaded statements for periods which have ended.
+
+    A closed period's statement almost never changes, so once downloaded it
+    is answered from local disk until explicitly refreshed or invalidated.
+    Calls block on SQLite, so routes make them with run_in_threadpool.
+    """
+
+    def __init__(self, path=STATEMENT_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS statement (
+                    account_id TEXT NOT NULL,
+                    start_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (account_id, start_date, end_date)
+                )"""
+            )
+
+    def get(self, account_id, startDate, endDate):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT body FROM statement WHERE account_id = ? AND start_date = ? AND end_date = ?",  # noqa: E501
+                (account_id, startDate, endDate),
+            ).fetchone()
+        record_cache_lookup("statement-disk", row is not None)
+        return row[0] if row is not None else None
+
+    def put(self, account_id, startDate, endDate, body):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO statement VALUES (?, ?, ?, ?, ?)",
+                (account_id, startDate, endDate, body, time.time()),
+            )
+
+    def invalidate(self, account_id, startDate=None, endDate=None):
+        """Forget cached statements, optionally only those overlapping dates"""
+        query = "DELETE FROM statement WHERE account_id = ?"
+        params = [account_id]
+        if startDate is not None:
+            query += " AND end_date >= ?"
+            params.append(startDate)
+        if endDate is not None:
+            query += " AND start_date <= ?"
+            params.append(endDate)
+        with self.lock, self.db:
+            return self.db.execute(query, params).rowcount
+
+    def close(self):
+        self.db.close()
+
+
+# Statements date transactions by the UK's local time, not UTC
+LONDON = pytz.timezone("Europe/London")
+
+
+def london_date(transactionTime):
+    """yyyy-mm-dd in Europe/London of an ISO 8601 time such as Starling's"""
+    moment = datetime.fromisoformat(transactionTime.replace("Z", "+00:00"))
+    return moment.astimezone(LONDON).date().isoformat()
+
+
+class Ledger:
+    """Local, durable copy of the account's transactions feed.
+
+    Feed items are upserted by their feedItemUid, so replaying a sync is
+    harmless. The cursor is the latest updatedAt seen, the next sync only
+    asks Starling for items changed since then. Calls block on SQLite, so
+    routes make them with run_in_threadpool.
+    """
+
+    # Feed items with these statuses never reached the account
+    EXCLUDED_STATUSES = ("DECLINED", "REVERSED", "UPCOMING")
+
+    def __init__(self, path=LEDGER_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.synced_at = None
+        with self.lock, self.db:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS ledger_transaction (
+                    feed_item_uid TEXT PRIMARY KEY,
+                    account_id TEXT NOT NULL,
+                    transaction_time TEXT NOT NULL,
+                    transaction_date TEXT NOT NULL,
+                    counterparty TEXT NOT NULL,
+                    reference TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    spending_category TEXT NOT NULL,
+                    notes TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )"""
+            )
+            self.db.execute(
+                """CREATE INDEX IF NOT EXISTS ledger_transaction_date
+                ON ledger_transaction (account_id, transaction_date)"""
+            )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS ledger_cursor (
+                    account_id TEXT PRIMARY KEY,
+                    changes_since TEXT NOT NULL
+                )"""
+            )
+            if self.db.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # Ledgers from before version 1 dated transactions in UTC
+                self.db.create_function("london_date", 1, london_date)
+                self.db.execute(
+                    """UPDATE ledger_transaction
+                    SET transaction_date = london_date(transaction_time)"""
+                )
+                self.db.execute("PRAGMA user_version = 1")
+
+    def cursor(self, account_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT changes_since FROM ledger_cursor WHERE account_id = ?",
+                (account_id,),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def apply(self, account_id, feedItems):
+        """Upsert feed items and advance the cursor in one transaction"""
+        rows = []
+        cursor = self.cursor(account_id)
+        for item in feedItems:
+            updated_at = item.get("updatedAt") or item["transactionTime"]
+            amount = item["amount"]["minorUnits"]
+            if item.get("direction") == "OUT":
+                amount = -amount
+            rows.append(
+                (
+                    item["feedItemUid"],
+                    account_id,
+                    item["transactionTime"],
+                    london_date(item["transactionTime"]),
+                    item.get("counterPartyName") or "",
+                    item.get("reference") or "",
+                    item.get("source") or "",
+                    amount,
+                    item.get("spendingCategory") or "",
+                    item.get("userNote") or "",
+                    item.get("status") or "",
+                    updated_at,
+                )
+            )
+            if cursor is None or updated_at > cursor:
+                cursor = updated_at
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO ledger_transaction VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",  # noqa: E501
+                rows,
+            )
+            if cursor is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO ledger_cursor VALUES (?, ?)",
+                    (account_id, cursor),
+                )
+        self.synced_at = time.monotonic()
+        return len(rows)
+
+    def statement(self, account_id, startDate, endDate):
+        """Statement of ledger transactions dated startDate to endDate"""
+        placeholders = ", ".join("?" for _ in self.EXCLUDED_STATUSES)
+        with self.lock:
+            rows = self.db.execute(
+                f"""SELECT transaction_date, counterparty, reference, type,
+                    amount, spending_category, notes
+                FROM ledger_transaction
+                WHERE account_id = ?
+                AND transaction_date BETWEEN ? AND ?
+                AND status NOT IN ({placeholders})
+                ORDER BY transaction_time""",
+                (account_id, startDate, endDate, *self.EXCLUDED_STATUSES),
+            ).fetchall()
+        transactions = [
+            Transaction(
+                date.fromisoformat(transaction_date),
+                counterparty,
+                reference,
+                type,
+                amount,
+                None,
+                spending_category,
+                notes,
+            )
+            for (
+                transaction_date,
+                counterparty,
+                reference,
+                type,
+                amount,
+                spending_category,
+                notes,
+            ) in rows
+        ]
+        return Statement(list(STATEMENT_HEADER), transactions)
+
+    def close(self):
+        self.db.close()
+
+
+class StaleWhileRevalidate:
+    """In-process cache of a single value fetched by an async callable.
+
+    Callers get the cached value immediately, once it is older than ttl a
+    single background task refreshes it. Only the very first call waits on
+    the fetch. If a refresh fails the stale value is kept.
+    """
+
+    def __init__(self, fetch, ttl, name):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.name = name
+        self.value = None
+        self.fetched_at = None
+        self.refreshing = None
+
+    async def get(self):
+        record_cache_lookup(self.name, self.fetched_at is not None)
+        if self.fetched_at is None:
+            await self.refresh()
+        elif time.monotonic() - self.fetched_at > self.ttl:
+            self.refresh_in_background()
+        return self.value
+
+    async def refresh(self):
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self._refresh())
+        await asyncio.shield(self.refreshing)
+
+    def refresh_in_background(self):
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self._refresh())
+            self.refreshing.add_done_callback(self._log_failure)
+
+    async def _refresh(self):
+        try:
+            self.value = await self.fetch()
+            self.fetched_at = time.monotonic()
+        finally:
+            self.refreshing = None
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"Background refresh failed: {task.exception()}")
+
+
+class SingleFlight:
+    """Share one in-flight coroutine between concurrent callers of a key"""
+
+    def __init__(self):
+        self.inflight = {}
+
+    async def do(self, key, fetch):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # Shielded so one caller disconnecting doesn't cancel the others
+        return await asyncio.shield(task)
+
+
+class LRUCache:
+    """Bounded, thread safe mapping which forgets the least recently used"""
+
+    def __init__(self, maxsize, name):
+        self.maxsize = maxsize
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+        record_cache_lookup(self.name, value is not None)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class Scheduler:
+    """Runs jobs on the event loop every so many seconds
+
+    A job which fails is logged and tried again at its next interval.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.tasks = []
+
+    def every(self, interval, job):
+        """Schedule job, a coroutine function. An interval of 0 disables it"""
+        if interval > 0:
+            self.jobs.append((interval, job))
+
+    def start(self):
+        self.tasks = [
+            asyncio.ensure_future(self._run(interval, job))
+            for interval, job in self.jobs
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    @staticmethod
+    async def _run(interval, job):
+        while True:
+            try:
+                await job()
+            except Exception as e:
+                log.error(f"Scheduled {job.__name__} failed: {e}")
+            await asyncio.sleep(interval)
+
+
+def hold_lock(path):
+    """Open file holding an exclusive lock on path, None if it's held
+
+    The lock lasts until the file is closed or the process exits, however
+    it ends, so a worker which dies can't leave it held.
+    """
+    fp = open(path, "a")
+    try:
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fp.close()
+        return None
+    return fp
+
+
+def is_closed_period(endDate):
+    """True when endDate (yyyy-mm-dd) is before today, so won't change"""
+    try:
+        return datetime.strptime(endDate, "%Y-%m-%d").date() < date.today()
+    except ValueError:
+        return False
+
+
+class SamplingProfiler:
+    """Samples one thread's stack every interval seconds from a daemon thread
+
+    Sampling the event loop thread records whatever it runs, so requests
+    handled concurrently with the profiled one show up too. Stacks are
+    counted in collapsed form ("outer;inner;leaf"), ready for flamegraph.pl
+    or speedscope.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                module = os.path.basename(code.co_filename)
+                names.append(
+                    f"{code.co_name} ({module}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def collapsed(self):
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.items()
+        )
+
+
+starling_async = AsyncStarlingClient()
+statement_cache = StatementCache()
+# Parsed closed-period statements, with their columns once aggregated
+closed_statements = LRUCache(STATEMENT_MEMORY_CACHE_SIZE, "statement-memory")
+statement_flights = SingleFlight()
+ledger = Ledger() if LEDGER_ENABLED else None
+ledger_flights = SingleFlight()
 
 
 title = "Karma Computing Accounts"
@@ -46,7 +707,46 @@ View balance, and cashflow. <small>[Code](https://github.com/KarmaComputing/bala
 
 """
 
-app = FastAPI(title=title, description=description)
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse which counts its encoding as the serialize phase"""
+
+    def render(self, content):
+        with timed("serialize"):
+            return super().render(content)
+
+
+class TimedORJSONResponse(JSONResponse):
+    """TimedJSONResponse encoded by orjson, several times faster"""
+
+    def render(self, content):
+        with timed("serialize"):
+            return orjson.dumps(
+                content,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+            )
+
+
+# Both produce the same compact JSON, orjson is opted in to with ORJSON_ENABLED
+JSONResponseClass = (
+    TimedORJSONResponse if ORJSON_ENABLED else TimedJSONResponse
+)
+
+
+def json_response(content):
+    """content, already made of plain JSON types, as a JSONResponseClass
+
+    Returning a response skips FastAPI's jsonable_encoder, which would only
+    walk and copy the route's dicts and lists before they are encoded.
+    """
+    return JSONResponseClass(content)
+
+
+app = FastAPI(
+    title=title,
+    description=description,
+    default_response_class=JSONResponseClass,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -57,20 +757,371 @@ app.add_middleware(
 )
 
 
-@app.get("/")
-def balance():
-    host = f"https://api.starlingbank.com/api/v2/accounts/{BANK_ACCOUNT_ID}/balance"  # noqa E501
-    headers["accept"] = "application/json"
-    req = requests.get(host, headers=headers)
+class RequestMetricsMiddleware:
+    """Records each request's latency and the requests in progress
+
+    The app returns once it has sent the last of the body, so a streamed
+    response is timed until it has been sent in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        # Unknown paths share a label so they can't grow the label set
+        route = scope["path"]
+        if route not in ROUTE_PATHS:
+            route = "unmatched"
+        start = time.perf_counter()
+        try:
+            with REQUESTS_IN_PROGRESS.track_inprogress():
+                await self.app(scope, receive, send)
+        finally:
+            REQUEST_LATENCY.labels(scope["method"], route).observe(
+                time.perf_counter() - start
+            )
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+class ServerTimingMiddleware:
+    """Server-Timing header of the time spent in each phase
+
+    With ?debug_timing=true the phases are also added to a JSON response's
+    body, under "server-timing" (non-object bodies are wrapped as
+    {"response": ..., "server-timing": ...}). Only those bodies are held
+    back, every other response passes straight through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        phases = {}
+        REQUEST_PHASES.set(phases)
+        query = QueryParams(scope["query_string"])
+        debug = query.get("debug_timing", "").lower() == "true"
+        start_time = time.perf_counter()
+        start = None
+        chunks = []
+
+        async def send_timed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                phases["total"] = time.perf_counter() - start_time
+                headers = MutableHeaders(raw=message["headers"])
+                headers["Server-Timing"] = ", ".join(
+                    f"{phase};dur={seconds * 1000:.3f}"
+                    for phase, seconds in phases.items()
+                )
+                if debug and headers.get("content-type") == "application/json":
+                    start = message
+                    return
+                return await send(message)
+
+            if message["type"] != "http.response.body" or start is None:
+                return await send(message)
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            content = json.loads(b"".join(chunks))
+            timing = {
+                phase: seconds * 1000 for phase, seconds in phases.items()
+            }
+            if isinstance(content, dict):
+                content["server-timing"] = timing
+            else:
+                content = {"response": content, "server-timing": timing}
+            body = JSONResponseClass(content).body
+            headers = MutableHeaders(raw=start["headers"])
+            headers["Content-Length"] = str(len(body))
+            await send(start)
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_timed)
+
+
+app.add_middleware(ServerTimingMiddleware)
+
+
+def profiling_requested(scope):
+    """True when the request carries the PROFILE_TOKEN, never if it's unset"""
+    if not PROFILE_TOKEN:
+        return False
+    token = Headers(scope=scope).get("X-Profile-Token") or QueryParams(
+        scope["query_string"]
+    ).get("profile_token", "")
+    return hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+class ProfileMiddleware:
+    """Sample the stacks of a request sent with X-Profile-Token
+
+    The token can also be given as ?profile_token=. Collapsed stacks are
+    written to PROFILE_DIR and the file's name returned in X-Profile.
+    Other requests pass straight through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiling_requested(scope):
+            return await self.app(scope, receive, send)
+
+        route = scope["path"].strip("/").replace("/", "_") or "root"
+        name = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{route}.folded"
+
+        async def send_named(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(raw=message["headers"])["X-Profile"] = name
+            await send(message)
+
+        profiler = SamplingProfiler(threading.get_ident())
+        profiler.start()
+        try:
+            # Returns once the body is sent, which is where a stream works
+            await self.app(scope, receive, send_named)
+        finally:
+            profiler.stop()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, name), "w") as fp:
+            fp.write(profiler.collapsed())
+        log.info(f"Profiled {scope['path']} to {name}")
+
+
+app.add_middleware(ProfileMiddleware)
+
+
+# Quality 11 is for static files, 5 compresses JSON nearly as well, far faster
+BROTLI_QUALITY = 5
+GZIP_LEVEL = 6
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+def accepted_encoding(accept_encoding):
+    """br or gzip if the Accept-Encoding header allows it, br preferred"""
+    accepted = set()
+    for coding in accept_encoding.lower().split(","):
+        coding, _, params = coding.partition(";")
+        params = params.replace(" ", "")
+        if params in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip())
+    for encoding in ("br", "gzip"):
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def compress(encoding, body):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL)
+
+
+class StreamCompressor:
+    """Compresses a streamed body chunk by chunk
+
+    Each chunk is flushed, so the client can decode every row as soon as
+    it's sent rather than once the compressor's buffer fills.
+    """
+
+    def __init__(self, encoding):
+        self.brotli = encoding == "br"
+        if self.brotli:
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        if self.brotli:
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return self.compressor.compress(chunk) + self.compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self):
+        if self.brotli:
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+compressed_bodies = LRUCache(COMPRESSION_CACHE_SIZE, "compressed-response")
+
+
+class CompressionMiddleware:
+    """Brotli or gzip encodes responses of at least COMPRESSION_MIN_SIZE
+
+    Streamed responses, those without a Content-Length, are compressed
+    chunk by chunk as they are sent, whatever their size.
+    Bodies of routes which call cache_compressed are kept compressed, keyed
+    by a digest of the uncompressed bytes, so an entry can never be stale.
+    """
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = accepted_encoding(
+            Headers(scope=scope).get("accept-encoding", "")
+        )
+        if encoding is None or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+
+        compression = {"cacheable": False}
+        RESPONSE_COMPRESSION.set(compression)
+        start = None
+        chunks = []
+        streamer = None
+
+        async def send_compressed(message):
+            nonlocal start, streamer
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                length = headers.get("content-length")
+                if (
+                    "content-encoding" in headers
+                    or not headers.get("content-type", "").startswith(
+                        COMPRESSIBLE_TYPES
+                    )
+                    or (length is not None and int(length) < self.minimum_size)
+                ):
+                    return await send(message)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if length is None:
+                    # Streamed, compress each chunk as it's sent
+                    streamer = StreamCompressor(encoding)
+                    return await send(message)
+                start = message
+                return
+
+            if message["type"] != "http.response.body" or (
+                start is None and streamer is None
+            ):
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if streamer is not None:
+                body = streamer.compress(body)
+                if not more_body:
+                    body += streamer.finish()
+                return await send({**message, "body": body})
+
+            chunks.append(body)
+            if more_body:
+                return
+            body = b"".join(chunks)
+            began = time.perf_counter()
+            key = None
+            compressed = None
+            if compression["cacheable"]:
+                digest = hashlib.blake2b(body, digest_size=16).digest()
+                key = (encoding, digest)
+                compressed = compressed_bodies.get(key)
+            if compressed is None:
+                compressed = compress(encoding, body)
+                if key is not None:
+                    compressed_bodies.put(key, compressed)
+            headers = MutableHeaders(raw=start["headers"])
+            headers["Content-Length"] = str(len(compressed))
+            if "server-timing" in headers:
+                took = (time.perf_counter() - began) * 1000
+                headers["Server-Timing"] += f", compress;dur={took:.3f}"
+            await send(start)
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
+
+
+# Added last so it's outermost, compressing what the other middleware return
+app.add_middleware(CompressionMiddleware)
+
+
+@app.exception_handler(StarlingError)
+async def starling_error(request, exc):
+    """Starling failed and there was nothing cached to answer with"""
+    log.error(f"Error from Starling for {request.url.path}:\n{exc}")
+    return PlainTextResponse(
+        "Error from Starling, check the logs", status_code=502
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Every worker writes its metrics there, report them all
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("startup")
+async def start_scheduler():
+    """Run the scheduler in one process, the first worker to lock the file
+
+    Other workers fetch on demand, bounded by their caches' TTLs.
+    """
+    global scheduler_lock
+    if not SCHEDULER_ENABLED:
+        return
+    scheduler_lock = hold_lock(SCHEDULER_LOCK_PATH)
+    if scheduler_lock is None:
+        log.info("Another worker holds the scheduler lock, not scheduling")
+        return
+    scheduler.start()
+
+
+@app.on_event("startup")
+async def start_monitor():
+    monitor.start()
+
+
+@app.on_event("shutdown")
+async def close_starling_client():
+    await scheduler.stop()
+    await monitor.stop()
+    if scheduler_lock is not None:
+        scheduler_lock.close()
+    await starling_async.close()
+    statement_cache.close()
+    if ledger is not None:
+        ledger.close()
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+async def fetch_balance():
+    path = f"/api/v2/accounts/{BANK_ACCOUNT_ID}/balance"
+    req = await starling_async.get(path)
     if req.status_code != 200:
-        print(f"Error getting balance:\nStatus:{req.status_code}\n{req.text}")
-        return "Error getting balance, check the logs"
+        raise StarlingError(f"Status:{req.status_code}\n{req.text}")
+    return req.json()
 
-    resp = req.json()
+
+balance_cache = StaleWhileRevalidate(
+    fetch_balance, ttl=BALANCE_CACHE_TTL, name="balance"
+)
+
+
+@app.get("/")
+async def balance():
+    resp = await balance_cache.get()
     balance = resp["clearedBalance"]["minorUnits"]
-    balance_human_readable = format_currency(
-        balance / 100, "GBP", locale="en_GB"
-    )  # noqa
+    balance_human_readable = format_pence(balance)
     resp = {
         "balance": balance,
         "balance-human-readable": f"{balance_human_readable}",
@@ -78,117 +1129,980 @@ def balance():
     return resp
 
 
+async def fetch_available_periods():
+    path = f"/api/v2/accounts/{BANK_ACCOUNT_ID}/statement/available-periods"  # noqa
+    req = await starling_async.get(path)
+    if req.status_code != 200:
+        raise StarlingError(f"Status:{req.status_code}\n{req.text}")
+    return req.json()
+
+
+periods_cache = StaleWhileRevalidate(
+    fetch_available_periods, ttl=PREFETCH_PERIODS_INTERVAL, name="periods"
+)
+
+
 @app.get("/statement/available-periods")
-def get_available_periods():
-    host = f"https://api.starlingbank.com/api/v2/accounts/{BANK_ACCOUNT_ID}/statement/available-periods"  # noqa
-    req = requests.get(host, headers=headers)
-    resp = req.json()
-    return resp
+async def get_available_periods():
+    return await periods_cache.get()
 
 
 @app.get("/statement/downloadForDateRange")
-def get_statement_range_CSV(
+async def get_statement_range_CSV(
     startDate: str = "yyyy-mm-dd",
     endDate: str = "yyyy-mm-dd",
     DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
+    refresh: bool = False,
 ):
-    host = f"https://api.starlingbank.com/api/v2/accounts/{BANK_ACCOUNT_ID}/statement/downloadForDateRange"  # noqa
-    host += f"?start={startDate}"
-    host += f"&end={endDate}"
-
-    headers["accept"] = "text/csv"
-    req = requests.get(host, headers=headers)
-    resp = req.text
-    fp = io.StringIO(resp)
-    csvreader = csv.reader(fp, delimiter=",")
-    rows = []
-    for row in csvreader:
-        if (
-            DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD is not None
-            and DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD
-            == os.getenv("DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD")
-        ):
-            pass
-        else:
-            row[1] = "#"
-            row[2] = "#"
-        rows.append(row)
-    return rows
+    if refresh:
+        require_privilege(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "refresh")
+    redaction = redaction_for(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD)
+    statement = await shared_statement(startDate, endDate, refresh)
+    if is_closed_period(endDate):
+        cache_compressed()
+    return json_response(statement.redacted(redaction).rows())
+
+
+async def shared_statement(startDate, endDate, refresh=False):
+    """Parsed, unredacted statement, shared between concurrent callers"""
+    key = (BANK_ACCOUNT_ID, startDate, endDate, "text/csv", refresh)
+    return await statement_flights.do(
+        key, lambda: download_statement(startDate, endDate, refresh)
+    )
+
+
+async def cashflow_statement(
+    startDate,
+    endDate,
+    sections,
+    redaction=None,
+    refresh=False,
+):
+    """Statement for a cashflow, only redacted when it's returned
+
+    redaction is a RedactionPlan, MASKED by default.
+    """
+    statement = await cashflow_source(startDate, endDate, refresh)
+    if "statement" in sections:
+        statement = statement.redacted(redaction or MASKED)
+    return statement
+
+
+def this_month():
+    """First and last day of the current month, as yyyy-mm-dd"""
+    today = date.today()
+    startDate = today.strftime("%Y-%m-01")  # Always first day of current month
+    last_day = calendar.monthrange(today.year, int(today.month))[1]
+    endDate = today.strftime(f"%Y-%m-{last_day}")
+    return startDate, endDate
+
+
+async def fetch_this_month_statement():
+    startDate, endDate = this_month()
+    return startDate, await shared_statement(startDate, endDate)
+
+
+# The current month is still open so isn't in the closed-period caches
+this_month_cache = StaleWhileRevalidate(
+    fetch_this_month_statement,
+    ttl=PREFETCH_STATEMENT_INTERVAL,
+    name="statement-this-month",
+)
 
 
-def calculateCashflow(statementCSV):
-    credits = []
-    debits = []
+async def cashflow_source(startDate, endDate, refresh=False):
+    """Unredacted statement for cashflow routes, from the ledger if enabled"""
+    if ledger is None:
+        if not refresh and (startDate, endDate) == this_month():
+            cachedStartDate, statement = await this_month_cache.get()
+            if cachedStartDate == startDate:
+                return statement
+        return await shared_statement(startDate, endDate, refresh)
     try:
-        for row in statementCSV[1:-1]:  # Skip header
-            amount = float(row[4])
-            if amount < 0:
-                debits.append(amount)
-            else:
-                credits.append(amount)
-    except IndexError as e:
-        print(f"{e}")
-        print("error")
-
-    total_credits = round(sum(credits), 2)
-    total_credits_human_readable = format_currency(
-        total_credits, "GBP", locale="en_GB"
-    )  # noqa: E501
-    total_debits = round(sum(debits), 2)
-    total_debits_human_readable = format_currency(
-        total_debits, "GBP", locale="en_GB"
-    )  # noqa: E501
-    cashflow = round(total_credits + total_debits, 2)
-    cashflow_human_readable = format_currency(cashflow, "GBP", locale="en_GB")
-    return {
-        "cashflow": cashflow,
-        "cashflow-human-readable": cashflow_human_readable,
-        "total-credits": total_credits,
-        "total-credits-human-readable": total_credits_human_readable,
-        "total-debits": total_debits,
-        "total-debits-human-readable": total_debits_human_readable,
-        "credits": credits,
-        "debits": debits,
-        "statement": statementCSVtoJson(statementCSV),
-    }
+        await sync_ledger(force=refresh)
+    except StarlingError as e:
+        log.error(f"Ledger sync failed, answering from the ledger as is: {e}")
+    return await run_in_threadpool(
+        ledger.statement, BANK_ACCOUNT_ID, startDate, endDate
+    )
+
+
+async def sync_ledger(force=False):
+    """Pull feed items changed since the ledger's cursor
+
+    Skipped if the last sync was under LEDGER_SYNC_INTERVAL seconds ago,
+    unless forced. Concurrent callers share one sync.
+    """
+    if (
+        not force
+        and ledger.synced_at is not None
+        and time.monotonic() - ledger.synced_at < LEDGER_SYNC_INTERVAL
+    ):
+        return 0
+    return await ledger_flights.do(BANK_ACCOUNT_ID, fetch_ledger_changes)
+
+
+async def fetch_ledger_changes():
+    categoryUid = await default_category()
+    path = f"/api/v2/feed/account/{BANK_ACCOUNT_ID}/category/{categoryUid}"
+    cursor = await run_in_threadpool(ledger.cursor, BANK_ACCOUNT_ID)
+    changesSince = cursor or LEDGER_SYNC_FROM
+    req = await starling_async.get(path, params={"changesSince": changesSince})
+    if req.status_code != 200:
+        raise StarlingError(f"Status:{req.status_code}\n{req.text}")
+    return await run_in_threadpool(
+        ledger.apply, BANK_ACCOUNT_ID, req.json()["feedItems"]
+    )
+
+
+async def default_category():
+    global BANK_CATEGORY_ID
+    if BANK_CATEGORY_ID is None:
+        req = await starling_async.get("/api/v2/accounts")
+        if req.status_code != 200:
+            raise StarlingError(f"Status:{req.status_code}\n{req.text}")
+        for account in req.json()["accounts"]:
+            if account["accountUid"] == BANK_ACCOUNT_ID:
+                BANK_CATEGORY_ID = account["defaultCategory"]
+        if BANK_CATEGORY_ID is None:
+            raise StarlingError(f"No account {BANK_ACCOUNT_ID} in /accounts")
+    return BANK_CATEGORY_ID
+
+
+@app.post("/ledger/sync")
+async def post_ledger_sync(
+    DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
+):
+    """Pull transaction changes into the ledger now"""
+    require_privilege(
+        DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "Syncing the ledger"
+    )
+    if ledger is None:
+        return PlainTextResponse("The ledger is not enabled", status_code=404)
+    return {"synced": await sync_ledger(force=True)}
+
+
+async def download_statement(startDate, endDate, refresh=False):
+    closed = is_closed_period(endDate)
+    key = (BANK_ACCOUNT_ID, startDate, endDate)
+    body = None
+    if closed and not refresh:
+        statement = closed_statements.get(key)
+        if statement is not None:
+            return statement
+        body = await run_in_threadpool(
+            statement_cache.get, BANK_ACCOUNT_ID, startDate, endDate
+        )
+    cacheable = body is not None
+    if body is None:
+        path = f"/api/v2/accounts/{BANK_ACCOUNT_ID}/statement/downloadForDateRange"  # noqa
+        params = {"start": startDate, "end": endDate}
+        req = await starling_async.get(path, accept="text/csv", params=params)
+        if req.status_code != 200:
+            raise StarlingError(f"Status:{req.status_code}\n{req.text}")
+        body = req.text
+        cacheable = closed
+        if cacheable:
+            await run_in_threadpool(
+                statement_cache.put, BANK_ACCOUNT_ID, startDate, endDate, body
+            )
+    # Parsing a long statement takes a while, keep the event loop responsive
+    statement = await run_in_threadpool(parseStatementCSV, body)
+    if cacheable:
+        closed_statements.put(key, statement)
+    return statement
+
+
+@app.delete("/statement/cache")
+async def invalidate_statement_cache(
+    startDate: Optional[str] = None,
+    endDate: Optional[str] = None,
+    DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
+):
+    """Forget cached closed-period statements so they are downloaded again"""
+    require_privilege(
+        DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "Invalidating the cache"
+    )
+    removed = await run_in_threadpool(
+        statement_cache.invalidate, BANK_ACCOUNT_ID, startDate, endDate
+    )
+    closed_statements.clear()
+    return {"invalidated": removed}
+
+
+STATEMENT_HEADER = (
+    "Date",
+    "Counter Party",
+    "Reference",
+    "Type",
+    "Amount (GBP)",
+    "Balance (GBP)",
+    "Spending Category",
+    "Notes",
+)
+
+
+class Transaction:
+    """One statement row, parsed once into typed fields
+
+    amount and balance are integer pence, balance is None when absent. row
+    is the CSV cells it was parsed from, returned by to_row as downloaded,
+    or None for transactions from the ledger.
+    """
+
+    __slots__ = (
+        "date",
+        "counterparty",
+        "reference",
+        "type",
+        "amount",
+        "balance",
+        "spending_category",
+        "notes",
+        "row",
+    )
+
+    def __init__(
+        self,
+        date,
+        counterparty,
+        reference,
+        type,
+        amount,
+        balance,
+        spending_category,
+        notes,
+        row=None,
+    ):
+        self.date = date
+        self.counterparty = counterparty
+        self.reference = reference
+        self.type = type
+        self.amount = amount
+        self.balance = balance
+        self.spending_category = spending_category
+        self.notes = notes
+        self.row = row
+
+    @classmethod
+    def from_row(cls, row):
+        # Columns are in STATEMENT_HEADER order
+        cells = row + [""] * (8 - len(row))
+        return cls(
+            parse_statement_date(cells[0]),
+            cells[1],
+            cells[2],
+            cells[3],
+            parse_pence(cells[4]),
+            parse_pence(cells[5]) if cells[5].strip() else None,
+            cells[6],
+            cells[7],
+            row,
+        )
+
+    def to_row(self):
+        if self.row is not None:
+            return self.row
+        return [
+            self.date.strftime("%d/%m/%Y"),
+            self.counterparty,
+            self.reference,
+            self.type,
+            pence_to_str(self.amount),
+            pence_to_str(self.balance) if self.balance is not None else "",
+            self.spending_category,
+            self.notes,
+        ]
+
+
+class Statement:
+    """A statement's header row and its transactions
+
+    unparsed holds the rows which couldn't be parsed, as (index, row) where
+    index is the number of transactions before the row. They are returned
+    with the statement's rows but left out of its aggregates.
+    """
+
+    __slots__ = ("header", "transactions", "unparsed", "_columns", "_views")
+
+    def __init__(self, header, transactions, unparsed=()):
+        self.header = header
+        self.transactions = transactions
+        self.unparsed = unparsed
+        self._columns = None
+        self._views = {}
+
+    def columns(self):
+        """TransactionColumns of the transactions, built once on first use"""
+        if self._columns is None:
+            self._columns = TransactionColumns(self.transactions)
+        return self._columns
+
+    def redacted(self, redaction):
+        """The statement as seen through a RedactionPlan, built once per plan
+
+        Cached statements are kept unredacted and shared, so privileged and
+        anonymous callers use one download and each view is masked once.
+        """
+        if redaction is FULL_DETAIL:
+            return self
+        view = self._views.get(redaction)
+        if view is None:
+            view = self._views[redaction] = redaction.apply(self)
+        return view
+
+    def rows(self):
+        """Back to CSV style rows, header first, none for an empty download"""
+        with timed("serialize"):
+            return list(self.iter_rows())
+
+    def iter_rows(self):
+        """CSV style rows, unparseable ones back where they were downloaded"""
+        if self.header:
+            yield self.header
+        transactions = iter(self.transactions)
+        position = 0
+        for index, row in self.unparsed:
+            for transaction in islice(transactions, index - position):
+                yield transaction.to_row()
+            yield row
+            position = index
+        for transaction in transactions:
+            yield transaction.to_row()
+
+
+def parseStatementCSV(resp):
+    with timed("parse"):
+        fp = io.StringIO(resp)
+        csvreader = csv.reader(fp, delimiter=",")
+        header = next(csvreader, [])
+        transactions = []
+        unparsed = []
+        for row in csvreader:
+            if not row:
+                continue
+            try:
+                transactions.append(Transaction.from_row(row))
+            except ValueError as e:
+                log.warning(f"Unparseable row {row} left out of totals: {e}")
+                unparsed.append((len(transactions), row))
+    ROWS_PARSED.inc(len(transactions))
+    return Statement(header, transactions, unparsed)
+
+
+class RedactionPlan:
+    """Statement columns to mask, compiled once into one getter per column
+
+    Plans are immutable and shared, redaction_for picks one per request.
+    """
+
+    def __init__(self, masked=()):
+        self.masked = frozenset(masked)
+        self._indexes = tuple(
+            i
+            for i, column in enumerate(STATEMENT_HEADER)
+            if column in self.masked
+        )
+        # Transaction's slots are in STATEMENT_HEADER order
+        self._getters = tuple(
+            None if column in self.masked else attrgetter(slot)
+            for column, slot in zip(STATEMENT_HEADER, Transaction.__slots__)
+        )
+
+    def row(self, row):
+        """Copy of a CSV row, such as the header, with masked columns as #"""
+        if not self._indexes:
+            return row
+        row = list(row)
+        for i in self._indexes:
+            if i < len(row):
+                row[i] = "#"
+        return row
+
+    def transaction(self, transaction):
+        if not self._indexes:
+            return transaction
+        fields = [
+            "#" if get is None else get(transaction) for get in self._getters
+        ]
+        return Transaction(*fields, self.source_row(transaction))
+
+    def source_row(self, transaction):
+        """Masked copy of the CSV cells transaction was parsed from, if any"""
+        if transaction.row is None:
+            return None
+        return self.row(transaction.row)
+
+    def apply(self, statement):
+        """Masked copy of statement, which may be shared so isn't modified
+
+        Each column is built in one pass over the transactions, then the
+        columns are zipped back into transactions.
+        """
+        if not self._indexes:
+            return statement
+        transactions = statement.transactions
+        columns = [
+            repeat("#", len(transactions))
+            if get is None
+            else map(get, transactions)
+            for get in self._getters
+        ]
+        columns.append(map(self.source_row, transactions))
+        return Statement(
+            self.row(statement.header),
+            list(starmap(Transaction, zip(*columns))),
+            [(index, self.row(row)) for index, row in statement.unparsed],
+        )
+
+
+FULL_DETAIL = RedactionPlan()
+MASKED = RedactionPlan(("Counter Party", "Reference", "Notes"))
+
+
+def redaction_for(password=None):
+    """FULL_DETAIL if password is DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD
+
+    Compared in constant time, and never matches while the setting is unset.
+    """
+    if password is None or not DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD:
+        return MASKED
+    if hmac.compare_digest(
+        password.encode(), DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD.encode()
+    ):
+        return FULL_DETAIL
+    return MASKED
+
+
+def require_privilege(password, action):
+    """403 unless password is DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD
+
+    For requests which spend the upstream rate budget or drop caches.
+    """
+    if redaction_for(password) is not FULL_DETAIL:
+        raise HTTPException(
+            status_code=403,
+            detail=f"{action} needs DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD",
+        )
+
+
+class StatementFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+@app.get("/statement/downloadForDateRange/stream")
+async def stream_statement_range(
+    startDate: str = "yyyy-mm-dd",
+    endDate: str = "yyyy-mm-dd",
+    DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
+    fmt: StatementFormat = Query(StatementFormat.ndjson, alias="format"),
+):
+    """Stream the statement row by row as NDJSON objects or CSV
+
+    The upstream body is read incrementally, so memory stays flat and the
+    first rows are sent before the download has finished.
+    """
+    body = None
+    if is_closed_period(endDate):
+        body = await run_in_threadpool(
+            statement_cache.get, BANK_ACCOUNT_ID, startDate, endDate
+        )
+
+    if body is not None:
+        upstream = None
+        rows = iter_csv_rows(aiter_once(body))
+    else:
+        path = f"/api/v2/accounts/{BANK_ACCOUNT_ID}/statement/downloadForDateRange"  # noqa
+        params = {"start": startDate, "end": endDate}
+        upstream = await starling_async.stream(
+            path, accept="text/csv", params=params
+        )
+        if upstream.status_code != 200:
+            await upstream.aread()
+            await upstream.aclose()
+            log.error(
+                f"Error getting statement:\nStatus:{upstream.status_code}\n{upstream.text}"  # noqa: E501
+            )
+            return PlainTextResponse(
+                "Error getting statement, check the logs", status_code=502
+            )
+        rows = iter_csv_rows(upstream.aiter_text())
+
+    redaction = redaction_for(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD)
+
+    def encode_csv(row):
+        fp = io.StringIO()
+        csv.writer(fp).writerow(row)
+        return fp.getvalue()
+
+    async def encode():
+        try:
+            header = True
+            async for row in rows:
+                if header:
+                    header = False
+                    if fmt is StatementFormat.csv:
+                        yield encode_csv(redaction.row(row))
+                    continue
+                # Rows are sent as downloaded, there's nothing to total
+                ROWS_PARSED.inc()
+                row = redaction.row(row)
+                if fmt is StatementFormat.csv:
+                    yield encode_csv(row)
+                elif ORJSON_ENABLED:
+                    yield orjson.dumps(statementRowToJson(row)) + b"\n"
+                else:
+                    yield json.dumps(
+                        statementRowToJson(row),
+                        ensure_ascii=False,
+                        separators=(",", ":"),
+                    ) + "\n"
+        finally:
+            if upstream is not None:
+                await upstream.aclose()
+                starling_async.record_stream_bytes(path, upstream)
+
+    media_type = {
+        StatementFormat.ndjson: "application/x-ndjson",
+        StatementFormat.csv: "text/csv",
+    }[fmt]
+    return StreamingResponse(encode(), media_type=media_type)
+
+
+async def aiter_once(text):
+    yield text
+
+
+async def iter_csv_rows(chunks):
+    """Parse CSV rows from an async iterator of text chunks as they arrive
+
+    A record only ends at a newline outside quotes, so quoted fields may
+    contain newlines. Blank lines are skipped.
+    """
+    pending = ""
+    async for chunk in chunks:
+        pending += chunk
+        # Find where the last complete record ends, then parse up to there
+        complete = 0
+        end = pending.find("\n")
+        while end != -1:
+            if pending.count('"', complete, end + 1) % 2 == 0:
+                complete = end + 1
+            end = pending.find("\n", end + 1)
+        if complete:
+            for row in csv.reader(io.StringIO(pending[:complete])):
+                if row:
+                    yield row
+            pending = pending[complete:]
+    if pending.strip():
+        yield next(csv.reader([pending]))
+
+
+# Optional, potentially large, parts of a cashflow response
+CASHFLOW_SECTIONS = frozenset(("credits", "debits", "statement"))
+
+
+def parse_include(include, default=CASHFLOW_SECTIONS):
+    """Sections named in a comma separated include= parameter
+
+    None means the default sections, an empty string means none of them.
+    """
+    if include is None:
+        return frozenset(default)
+    return frozenset(
+        section.strip() for section in include.split(",") if section.strip()
+    )
+
+
+def parse_pence(amount):
+    """Parse a decimal amount string such as "-12.30" into integer pence"""
+    amount = amount.strip().replace(",", "")
+    negative = amount.startswith("-")
+    if negative or amount.startswith("+"):
+        amount = amount[1:]
+    pounds, _, pence = amount.partition(".")
+    if not (pounds + pence).isdigit():
+        raise ValueError(f"Not an amount: {amount!r}")
+    value = int(pounds or 0) * 100 + int((pence + "00")[:2])
+    return -value if negative else value
+
+
+def pence_to_str(pence):
+    """Integer pence back to a decimal string, -1230 becomes -12.30"""
+    sign = "-" if pence < 0 else ""
+    pounds, pence = divmod(abs(pence), 100)
+    return f"{sign}{pounds}.{pence:02d}"
+
+
+def format_pence(pence):
+    with timed("format"):
+        return format_currency(
+            Decimal(pence).scaleb(-2), "GBP", locale="en_GB"
+        )
 
 
-def statementCSVtoJson(statementCSV):
-    # ['Date', 'Counter Party', 'Reference', 'Type', 'Amount (GBP)', 'Balance (GBP)', 'Spending Category', 'Notes']
-    statementItems = []
-    for statementItem in statementCSV:
-        statementItems.append(
+class CashflowTotals:
+    """Credits and debits totals in integer pence"""
+
+    __slots__ = (
+        "total_credits",
+        "total_debits",
+        "credit_count",
+        "debit_count",
+        "min_amount",
+        "max_amount",
+        "credits",
+        "debits",
+    )
+
+    def __init__(self, include=CASHFLOW_SECTIONS):
+        self.total_credits = 0
+        self.total_debits = 0
+        self.credit_count = 0
+        self.debit_count = 0
+        self.min_amount = None
+        self.max_amount = None
+        # Individual amounts are only kept when the caller wants them back
+        self.credits = [] if "credits" in include else None
+        self.debits = [] if "debits" in include else None
+
+    @classmethod
+    def from_amounts(cls, amounts, include=CASHFLOW_SECTIONS):
+        """Totals of an int64 array of pence, as vectorised reductions"""
+        totals = cls(include=include)
+        is_debit = amounts < 0
+        debits = amounts[is_debit]
+        credits = amounts[~is_debit]
+        totals.total_credits = int(credits.sum())
+        totals.total_debits = int(debits.sum())
+        totals.credit_count = len(credits)
+        totals.debit_count = len(debits)
+        if len(amounts):
+            totals.min_amount = int(amounts.min())
+            totals.max_amount = int(amounts.max())
+        if totals.credits is not None:
+            totals.credits = (credits / 100).tolist()
+        if totals.debits is not None:
+            totals.debits = (debits / 100).tolist()
+        return totals
+
+    def result(self):
+        cashflow = self.total_credits + self.total_debits
+        resp = {
+            "cashflow": cashflow / 100,
+            "cashflow-human-readable": format_pence(cashflow),
+            "total-credits": self.total_credits / 100,
+            "total-credits-human-readable": format_pence(self.total_credits),
+            "total-debits": self.total_debits / 100,
+            "total-debits-human-readable": format_pence(self.total_debits),
+            "credit-count": self.credit_count,
+            "debit-count": self.debit_count,
+            "min-amount": (
+                self.min_amount / 100 if self.min_amount is not None else None
+            ),
+            "max-amount": (
+                self.max_amount / 100 if self.max_amount is not None else None
+            ),
+        }
+        if self.credits is not None:
+            resp["credits"] = self.credits
+        if self.debits is not None:
+            resp["debits"] = self.debits
+        return resp
+
+
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class TransactionColumns:
+    """A statement's transactions held as columnar NumPy arrays
+
+    Dates are datetime64[D], amounts int64 pence and spending categories
+    indices into the sorted array of unique categories. Each column is
+    built on first use, most aggregations only read amounts. Aggregations
+    are vectorised reductions rather than Python loops.
+    """
+
+    __slots__ = (
+        "transactions",
+        "_dates",
+        "_amounts",
+        "_categories",
+        "_category_codes",
+    )
+
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self._dates = None
+        self._amounts = None
+        self._categories = None
+        self._category_codes = None
+
+    @property
+    def dates(self):
+        if self._dates is None:
+            ordinals = np.fromiter(
+                (t.date.toordinal() for t in self.transactions),
+                dtype=np.int64,
+                count=len(self.transactions),
+            )
+            days = ordinals - UNIX_EPOCH_ORDINAL
+            self._dates = days.astype("datetime64[D]")
+        return self._dates
+
+    @property
+    def amounts(self):
+        if self._amounts is None:
+            self._amounts = np.fromiter(
+                (t.amount for t in self.transactions),
+                dtype=np.int64,
+                count=len(self.transactions),
+            )
+        return self._amounts
+
+    @property
+    def categories(self):
+        if self._categories is None:
+            self._encode_categories()
+        return self._categories
+
+    @property
+    def category_codes(self):
+        if self._category_codes is None:
+            self._encode_categories()
+        return self._category_codes
+
+    def _encode_categories(self):
+        # A dict numbers categories faster than np.unique sorts strings
+        codes = {}
+        first_seen = np.fromiter(
+            (
+                codes.setdefault(t.spending_category, len(codes))
+                for t in self.transactions
+            ),
+            dtype=np.intp,
+            count=len(self.transactions),
+        )
+        names = np.array(list(codes), dtype=str)
+        order = np.argsort(names)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self._categories = names[order]
+        self._category_codes = rank[first_seen]
+
+    def between(self, start, end):
+        """Boolean mask of transactions dated start to end inclusive"""
+        return (self.dates >= np.datetime64(start, "D")) & (
+            self.dates <= np.datetime64(end, "D")
+        )
+
+    def totals(self, mask=None, include=CASHFLOW_SECTIONS):
+        amounts = self.amounts if mask is None else self.amounts[mask]
+        return CashflowTotals.from_amounts(amounts, include)
+
+    def group_totals(self, keys, mask=None, include=CASHFLOW_SECTIONS):
+        """CashflowTotals per unique value of keys, one array per column"""
+        amounts = self.amounts
+        if mask is not None:
+            keys = keys[mask]
+            amounts = amounts[mask]
+        groups, inverse = np.unique(keys, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(groups)))[:-1]
+        return {
+            group: CashflowTotals.from_amounts(group_amounts, include)
+            for group, group_amounts in zip(
+                groups.tolist(), np.split(amounts[order], bounds)
+            )
+        }
+
+    def bucket_starts(self, granularity):
+        """First day of each transaction's time bucket, as datetime64[D]"""
+        dates = self.dates
+        if granularity is Granularity.daily:
+            return dates
+        if granularity is Granularity.weekly:
+            # 1970-01-01 was a Thursday, weeks start on Monday
+            weekday = (dates.astype(np.int64) + 3) % 7
+            return dates - weekday.astype("timedelta64[D]")
+        if granularity is Granularity.monthly:
+            return dates.astype("datetime64[M]").astype("datetime64[D]")
+        if granularity is Granularity.quarterly:
+            months = dates.astype("datetime64[M]").astype(np.int64)
+            quarters = (months - months % 3).astype("datetime64[M]")
+            return quarters.astype("datetime64[D]")
+        return dates.astype("datetime64[Y]").astype("datetime64[D]")
+
+
+def calculateCashflow(statement, include=CASHFLOW_SECTIONS):
+    with timed("aggregate"):
+        totals = statement.columns().totals(include=include)
+    resp = totals.result()
+    if "statement" in include:
+        resp["statement"] = statementCSVtoJson(statement)
+    return resp
+
+
+def parse_statement_date(value):
+    """Statement dates are dd/mm/yyyy, also accept yyyy-mm-dd"""
+    try:
+        return datetime.strptime(value, "%d/%m/%Y").date()
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def calculateCashflowByMonth(statement, months, include=CASHFLOW_SECTIONS):
+    """Cashflow per month from one statement spanning all of months
+
+    months is a list of (startDate, endDate) as built by
+    cashflow_last_n_months. Transactions are grouped by month in one pass.
+    """
+    with timed("aggregate"):
+        columns = statement.columns()
+        totals = columns.group_totals(
+            columns.bucket_starts(Granularity.monthly), include=include
+        )
+
+        by_month = {}
+        if "statement" in include:
+            for transaction in statement.transactions:
+                by_month.setdefault(
+                    transaction.date.replace(day=1), []
+                ).append(transaction)
+
+    cashflows = []
+    for startDate, _ in months:
+        month = startDate.replace(day=1)
+        resp = totals.get(month, CashflowTotals(include=include)).result()
+        if "statement" in include:
+            resp["statement"] = statementCSVtoJson(
+                Statement(statement.header, by_month.get(month, []))
+            )
+        cashflows.append({startDate.strftime("%b-%Y"): resp})
+    return cashflows
+
+
+class Granularity(str, Enum):
+    daily = "daily"
+    weekly = "weekly"
+    monthly = "monthly"
+    quarterly = "quarterly"
+    yearly = "yearly"
+
+
+def bucket_start(day, granularity):
+    """First day of the bucket day falls in, weeks start on Monday"""
+    if granularity is Granularity.daily:
+        return day
+    if granularity is Granularity.weekly:
+        return day - timedelta(days=day.weekday())
+    if granularity is Granularity.monthly:
+        return day.replace(day=1)
+    if granularity is Granularity.quarterly:
+        return date(day.year, 3 * ((day.month - 1) // 3) + 1, 1)
+    return date(day.year, 1, 1)
+
+
+def next_bucket(start, granularity):
+    if granularity is Granularity.daily:
+        return start + timedelta(days=1)
+    if granularity is Granularity.weekly:
+        return start + timedelta(days=7)
+    months = {Granularity.monthly: 1, Granularity.quarterly: 3}.get(
+        granularity, 12
+    )
+    month = start.month - 1 + months
+    return date(start.year + month // 12, month % 12 + 1, 1)
+
+
+def calculateCashflowByBucket(
+    statement, start, end, granularity, include=frozenset()
+):
+    """Credits, debits and net per time bucket in one pass over the rows
+
+    Every bucket between start and end is returned, including empty ones,
+    so charts get a contiguous series.
+    """
+    with timed("aggregate"):
+        columns = statement.columns()
+        totals = columns.group_totals(
+            columns.bucket_starts(granularity),
+            mask=columns.between(start, end),
+            include=include,
+        )
+
+    buckets = []
+    bucket = bucket_start(start, granularity)
+    while bucket <= end:
+        buckets.append(
             {
-                "date": statementItem[0],
-                "counterparty": statementItem[1],
-                "reference": statementItem[2],
-                "type": statementItem[3],
-                "amount-gbp": statementItem[4],
-                "balance-gbp": statementItem[5],
-                "spending-category": statementItem[6],
-                "notes": statementItem[7],
+                "bucket-start": bucket.isoformat(),
+                **totals.get(bucket, CashflowTotals(include=include)).result(),
             }
         )
-    return statementItems
+        bucket = next_bucket(bucket, granularity)
+    return buckets
+
+
+def calculateCashflowByCategory(statement, start, end, include=frozenset()):
+    """Credits, debits and net per spending category"""
+    with timed("aggregate"):
+        columns = statement.columns()
+        totals = columns.group_totals(
+            columns.category_codes,
+            mask=columns.between(start, end),
+            include=include,
+        )
+    return {
+        str(columns.categories[code]): category_totals.result()
+        for code, category_totals in totals.items()
+    }
+
+
+def statementCSVtoJson(statement):
+    # The header row leads, as it did when this took raw CSV rows. An empty
+    # download has no header, and no rows.
+    with timed("serialize"):
+        return [statementRowToJson(row) for row in statement.iter_rows()]
+
+
+def statementRowToJson(statementItem):
+    if len(statementItem) < 8:
+        statementItem = statementItem + [""] * (8 - len(statementItem))
+    return {
+        "date": statementItem[0],
+        "counterparty": statementItem[1],
+        "reference": statementItem[2],
+        "type": statementItem[3],
+        "amount-gbp": statementItem[4],
+        "balance-gbp": statementItem[5],
+        "spending-category": statementItem[6],
+        "notes": statementItem[7],
+    }
 
 
 @app.get("/cashflow-this-month")
-def calculate_cashflow():
-    today = date.today()
-    startDate = today.strftime("%Y-%m-01")  # Always first day of current month
-    last_day = calendar.monthrange(today.year, int(today.month))[1]
-    endDate = today.strftime(f"%Y-%m-{last_day}")
+async def calculate_cashflow(include: Optional[str] = None):
+    sections = parse_include(include)
+    startDate, endDate = this_month()
 
-    statementCSV = get_statement_range_CSV(
-        startDate=startDate, endDate=endDate
+    statement = await cashflow_statement(
+        startDate=startDate, endDate=endDate, sections=sections
     )  # noqa: E501
 
-    return calculateCashflow(statementCSV)
+    return json_response(calculateCashflow(statement, include=sections))
 
 
 @app.get("/cashflow-last-month")
-def calculate_cashflow_last_month():
-
+async def calculate_cashflow_last_month(
+    refresh: bool = False,
+    include: Optional[str] = None,
+    DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
+):
+    if refresh:
+        require_privilege(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "refresh")
+    sections = parse_include(include)
     endDate = date.today().replace(day=1) - timedelta(days=1)
     startDate = (
         date.today().replace(day=1) - timedelta(days=endDate.day)
@@ -197,17 +2111,27 @@ def calculate_cashflow_last_month():
     )
     endDate = endDate.strftime("%Y-%m-%d")
 
-    statementCSV = get_statement_range_CSV(
-        startDate=startDate, endDate=endDate
+    statement = await cashflow_statement(
+        startDate=startDate,
+        endDate=endDate,
+        sections=sections,
+        refresh=refresh,
     )  # noqa: E501
 
-    return calculateCashflow(statementCSV)
+    return json_response(calculateCashflow(statement, include=sections))
 
 
 @app.get("/cashflow-by-month")
-def calculate_cashflow_by_month(
-    startDate: str = "yyyy-mm-dd", endDate: Optional[str] = None
+async def calculate_cashflow_by_month(
+    startDate: str = "yyyy-mm-dd",
+    endDate: Optional[str] = None,
+    refresh: bool = False,
+    include: Optional[str] = None,
+    DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
 ):
+    if refresh:
+        require_privilege(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "refresh")
+    sections = parse_include(include)
     if endDate is None:
         # If endDate is none, automatically work out
         # the last day of the month for the chosen startDate
@@ -215,42 +2139,174 @@ def calculate_cashflow_by_month(
         last_day = calendar.monthrange(start.year, int(start.month))[1]
         endDate = start.strftime(f"%Y-%m-{last_day}")
 
-    statementCSV = get_statement_range_CSV(
-        startDate=startDate, endDate=endDate
+    statement = await cashflow_statement(
+        startDate=startDate,
+        endDate=endDate,
+        sections=sections,
+        refresh=refresh,
     )  # noqa: E501
 
-    return calculateCashflow(statementCSV)
+    return json_response(calculateCashflow(statement, include=sections))
 
 
 @app.get("/cashflow-last-n-months")
-def cashflow_last_n_months(
+async def cashflow_last_n_months(
     number_of_months: int = 3,
     DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,  # noqa: E501
     include_this_month: bool = False,
+    refresh: bool = False,
+    single_fetch: bool = False,
+    include: Optional[str] = None,
 ):
-    """Display cashflow for the last n months"""
-    cashflows = []
+    """Display cashflow for the last n months
+
+    With single_fetch the whole span is downloaded as one statement and
+    grouped by month, rather than downloading each month separately.
+    include selects which of credits, debits and statement are returned.
+    """
+    if refresh:
+        require_privilege(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "refresh")
+    sections = parse_include(include)
+    redaction = redaction_for(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD)
+    months = []
 
     # Get last month from today
     endDate = date.today()
     if include_this_month is False:  # By default, we *don't* include current month.
         endDate = date.today().replace(day=1) - timedelta(days=1)
 
-    startDate = date.today().replace(day=1) - timedelta(days=endDate.day)
+    startDate = endDate.replace(day=1)
     i = 0
     while i < number_of_months:
-        statementCSV = get_statement_range_CSV(
-            startDate=startDate.strftime("%Y-%m-01"),
-            endDate=endDate.strftime("%Y-%m-%d"),
-            DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD=DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD,  # noqa: E501
-        )  # noqa: E501
-        cashflows.append(
-            {startDate.strftime("%b-%Y"): calculateCashflow(statementCSV)}
-        )  # noqa: E501
+        months.append((startDate, endDate))
 
         # Got back another month
         endDate = endDate.replace(day=1) - timedelta(days=1)
         startDate = endDate.replace(day=1)
         i += 1
 
-    return cashflows
+    if not include_this_month:
+        cache_compressed()
+
+    if single_fetch and months:
+        statement = await cashflow_statement(
+            startDate=months[-1][0].strftime("%Y-%m-01"),
+            endDate=months[0][1].strftime("%Y-%m-%d"),
+            sections=sections,
+            redaction=redaction,
+            refresh=refresh,
+        )
+        return json_response(
+            calculateCashflowByMonth(statement, months, sections)
+        )
+
+    semaphore = asyncio.Semaphore(max(1, CASHFLOW_MAX_CONCURRENCY))
+
+    async def fetch_month(month):
+        startDate, endDate = month
+        async with semaphore:
+            return await cashflow_statement(
+                startDate=startDate.strftime("%Y-%m-01"),
+                endDate=endDate.strftime("%Y-%m-%d"),
+                sections=sections,
+                redaction=redaction,
+                refresh=refresh,
+            )  # noqa: E501
+
+    # Fetch months concurrently, gather() keeps results in month order
+    statements = await asyncio.gather(*[fetch_month(m) for m in months])
+
+    cashflows = []
+    for (startDate, endDate), statement in zip(months, statements):
+        cashflows.append(
+            {
+                startDate.strftime("%b-%Y"): calculateCashflow(
+                    statement, include=sections
+                )
+            }
+        )  # noqa: E501
+
+    return json_response(cashflows)
+
+
+@app.get("/cashflow/buckets")
+async def cashflow_buckets(
+    start: date,
+    end: date,
+    granularity: Granularity = Granularity.monthly,
+    refresh: bool = False,
+    include: Optional[str] = "",
+    DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
+):
+    """Cashflow between start and end grouped into time buckets
+
+    Totals only by default, include=credits,debits adds the amounts.
+    """
+    if refresh:
+        require_privilege(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "refresh")
+    statement = await cashflow_source(
+        start.isoformat(), end.isoformat(), refresh
+    )
+    return json_response(
+        calculateCashflowByBucket(
+            statement, start, end, granularity, include=parse_include(include)
+        )
+    )
+
+
+@app.get("/cashflow/categories")
+async def cashflow_categories(
+    start: date,
+    end: date,
+    refresh: bool = False,
+    include: Optional[str] = "",
+    DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD: str = None,
+):
+    """Cashflow between start and end grouped by spending category"""
+    if refresh:
+        require_privilege(DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD, "refresh")
+    statement = await cashflow_source(
+        start.isoformat(), end.isoformat(), refresh
+    )
+    return json_response(
+        calculateCashflowByCategory(
+            statement, start, end, include=parse_include(include)
+        )
+    )
+
+
+async def refresh_statements():
+    if ledger is not None:
+        await sync_ledger(force=True)
+    else:
+        await this_month_cache.refresh()
+
+
+async def warm_cashflow_summaries():
+    """Build the statements, and their columns, behind common summaries"""
+    await calculate_cashflow(include="")
+    await calculate_cashflow_last_month(include="")
+    await cashflow_last_n_months(include="")
+
+
+scheduler = Scheduler()
+# Held by the one worker process which runs the scheduler
+scheduler_lock = None
+scheduler.every(PREFETCH_BALANCE_INTERVAL, balance_cache.refresh)
+scheduler.every(PREFETCH_STATEMENT_INTERVAL, refresh_statements)
+scheduler.every(PREFETCH_PERIODS_INTERVAL, periods_cache.refresh)
+scheduler.every(PREFETCH_SUMMARIES_INTERVAL, warm_cashflow_summaries)
+
+
+async def sample_runtime_metrics():
+    THREADS.set(threading.active_count())
+    start = time.perf_counter()
+    await asyncio.sleep(0)
+    EVENT_LOOP_LAG.set(time.perf_counter() - start)
+
+
+# Runs in every worker, whether or not it runs the scheduler
+monitor = Scheduler()
+monitor.every(EVENT_LOOP_LAG_INTERVAL, sample_runtime_metrics)
+
+ROUTE_PATHS = frozenset(route.path for route in app.routes)
@@ -0,0 +1,177 @@
+"""Local stand in for the parts of the Starling API this app uses
+
+Serves synthetic, deterministic data so the app can be run and benchmarked
+without real credentials:
+
+    MOCK_TRANSACTIONS_PER_DAY=50 MOCK_LATENCY_MS=80 \
+        uvicorn mock_starling:app --port 8001
+    STARLING_API_URL=http://127.0.0.1:8001 BANK_ACCOUNT_ID=mock-account \
+        uvicorn main:app
+"""
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+import asyncio
+import csv
+import io
+import os
+import random
+from datetime import date, datetime, timedelta
+
+MOCK_ACCOUNT_ID = os.getenv("MOCK_ACCOUNT_ID", "mock-account")
+MOCK_CATEGORY_ID = os.getenv("MOCK_CATEGORY_ID", "mock-category")
+MOCK_TRANSACTIONS_PER_DAY = int(os.getenv("MOCK_TRANSACTIONS_PER_DAY", 20))
+MOCK_LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", 50))
+MOCK_LATENCY_JITTER_MS = float(os.getenv("MOCK_LATENCY_JITTER_MS", 10))
+MOCK_HISTORY_DAYS = int(os.getenv("MOCK_HISTORY_DAYS", 365 * 3))
+
+COUNTERPARTIES = ["Acme Ltd", "Hosting Co", "Client A", "Client B", "HMRC"]
+CATEGORIES = ["INCOME", "BILLS_AND_SERVICES", "GENERAL", "PAYMENTS", "TAX"]
+TYPES = ["FASTER PAYMENT", "CARD", "DIRECT DEBIT", "STANDING ORDER"]
+
+app = FastAPI(title="Mock Starling API")
+
+
+async def inject_latency():
+    jitter = random.uniform(-MOCK_LATENCY_JITTER_MS, MOCK_LATENCY_JITTER_MS)
+    await asyncio.sleep(max(0, MOCK_LATENCY_MS + jitter) / 1000)
+
+
+def transactions_on(day):
+    """The same synthetic transactions every time for a given day
+
+    Yields (uid, day, counterparty, reference, type, pence, category)
+    """
+    rng = random.Random(day.toordinal())
+    for i in range(MOCK_TRANSACTIONS_PER_DAY):
+        pence = rng.randint(100, 250000)
+        if rng.random() < 0.6:
+            pence = -pence
+        yield (
+            f"{day.isoformat()}-{i}",
+            day,
+            rng.choice(COUNTERPARTIES),
+            f"REF {rng.randint(1000, 9999)}",
+            rng.choice(TYPES),
+            pence,
+            rng.choice(CATEGORIES),
+        )
+
+
+def days_between(start, end):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def pence_to_str(pence):
+    sign = "-" if pence < 0 else ""
+    pounds, pence = divmod(abs(pence), 100)
+    return f"{sign}{pounds}.{pence:02d}"
+
+
+@app.get("/api/v2/accounts")
+async def accounts():
+    await inject_latency()
+    return {
+        "accounts": [
+            {
+                "accountUid": MOCK_ACCOUNT_ID,
+                "defaultCategory": MOCK_CATEGORY_ID,
+                "currency": "GBP",
+            }
+        ]
+    }
+
+
+@app.get("/api/v2/accounts/{accountUid}/balance")
+async def balance(accountUid: str):
+    await inject_latency()
+    minorUnits = 1234567
+    return {
+        "clearedBalance": {"currency": "GBP", "minorUnits": minorUnits},
+        "effectiveBalance": {"currency": "GBP", "minorUnits": minorUnits},
+    }
+
+
+@app.get("/api/v2/accounts/{accountUid}/statement/available-periods")
+async def available_periods(accountUid: str):
+    await inject_latency()
+    first = date.today() - timedelta(days=MOCK_HISTORY_DAYS)
+    periods = []
+    month = first.replace(day=1)
+    while month <= date.today():
+        periods.append({"period": month.strftime("%Y-%m"), "partial": False})
+        month = (month + timedelta(days=32)).replace(day=1)
+    periods[-1]["partial"] = True
+    return periods
+
+
+@app.get("/api/v2/accounts/{accountUid}/statement/downloadForDateRange")
+async def download_for_date_range(accountUid: str, start: date, end: date):
+    await inject_latency()
+    fp = io.StringIO()
+    writer = csv.writer(fp)
+    writer.writerow(
+        [
+            "Date",
+            "Counter Party",
+            "Reference",
+            "Type",
+            "Amount (GBP)",
+            "Balance (GBP)",
+            "Spending Category",
+            "Notes",
+        ]
+    )
+    balance = 1000000
+    for day in days_between(start, end):
+        for _, _, counterparty, reference, type, pence, category in transactions_on(
+            day
+        ):
+            balance += pence
+            writer.writerow(
+                [
+                    day.strftime("%d/%m/%Y"),
+                    counterparty,
+                    reference,
+                    type,
+                    pence_to_str(pence),
+                    pence_to_str(balance),
+                    category,
+                    "",
+                ]
+            )
+    return PlainTextResponse(fp.getvalue(), media_type="text/csv")
+
+
+@app.get("/api/v2/feed/account/{accountUid}/category/{categoryUid}")
+async def feed(accountUid: str, categoryUid: str, changesSince: datetime):
+    """Every synthetic transaction counts as last updated at its own time"""
+    await inject_latency()
+    start = max(
+        changesSince.date(),
+        date.today() - timedelta(days=MOCK_HISTORY_DAYS),
+    )
+    feedItems = []
+    for day in days_between(start, date.today()):
+        for uid, _, counterparty, reference, type, pence, category in transactions_on(
+            day
+        ):
+            transactionTime = f"{day.isoformat()}T12:00:00.000Z"
+            feedItems.append(
+                {
+                    "feedItemUid": uid,
+                    "categoryUid": categoryUid,
+                    "amount": {"currency": "GBP", "minorUnits": abs(pence)},
+                    "direction": "OUT" if pence < 0 else "IN",
+                    "transactionTime": transactionTime,
+                    "updatedAt": transactionTime,
+                    "source": type,
+                    "status": "SETTLED",
+                    "counterPartyName": counterparty,
+                    "reference": reference,
+                    "spendingCategory": category,
+                }
+            )
+    return {"feedItems": feedItems}
@@ -0,0 +1,8 @@
+#! /usr/bin/env sh
+# Run by the Docker image before it starts the workers
+
+# Metrics files left by an earlier run would be added to this one's
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
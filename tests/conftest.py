@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Importing main must not touch real caches or credentials
+os.environ.setdefault("STATEMENT_CACHE_PATH", ":memory:")
+os.environ.setdefault("BANK_ACCOUNT_ID", "test-account")
+os.environ.setdefault("PERSONAL_ACCESS_TOKEN", "test-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
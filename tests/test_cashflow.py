@@ -0,0 +1,63 @@
+"""Cashflow aggregation"""
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import main
+
+# Newest first, as cashflow_last_n_months builds them
+MONTHS = [
+    (date(2021, 3, 1), date(2021, 3, 31)),
+    (date(2021, 2, 1), date(2021, 2, 28)),
+    (date(2021, 1, 1), date(2021, 1, 31)),
+    (date(2020, 12, 1), date(2020, 12, 31)),
+]
+
+
+def statement_csv(seed=0):
+    rng = random.Random(seed)
+    lines = [",".join(main.STATEMENT_HEADER)]
+    day = date(2020, 12, 1)
+    while day <= date(2021, 3, 31):
+        # No transactions at all in February
+        if day.month != 2:
+            for _ in range(rng.randint(0, 4)):
+                amount = main.pence_to_str(rng.randint(-50000, 50000))
+                lines.append(f"{day:%d/%m/%Y},Acme,ref,CARD,{amount},,G,")
+        day += timedelta(days=1)
+    return "\r\n".join(lines) + "\r\n"
+
+
+@pytest.mark.parametrize(
+    "include",
+    [
+        main.CASHFLOW_SECTIONS,
+        frozenset(),
+        frozenset(("credits", "debits")),
+        frozenset(("statement",)),
+    ],
+)
+def test_by_month_matches_each_month_alone(include):
+    statement = main.parseStatementCSV(statement_csv())
+    by_month = main.calculateCashflowByMonth(statement, MONTHS, include)
+
+    expected = []
+    for startDate, endDate in MONTHS:
+        month = main.Statement(
+            statement.header,
+            [
+                t
+                for t in statement.transactions
+                if startDate <= t.date <= endDate
+            ],
+        )
+        expected.append(
+            {
+                startDate.strftime("%b-%Y"): main.calculateCashflow(
+                    month, include=include
+                )
+            }
+        )
+    assert by_month == expected
+    assert by_month[1]["Feb-2021"]["credit-count"] == 0
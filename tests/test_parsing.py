@@ -0,0 +1,126 @@
+"""Amount parsing, time buckets and streamed CSV parsing"""
+import asyncio
+import csv
+import io
+from datetime import date, timedelta
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize(
+    "amount, pence",
+    [
+        ("-12.30", -1230),
+        ("12.3", 1230),
+        ("+7", 700),
+        ("0.05", 5),
+        ("-0.05", -5),
+        (".5", 50),
+        ("1,234.56", 123456),
+        (" 42.00 ", 4200),
+    ],
+)
+def test_parse_pence(amount, pence):
+    assert main.parse_pence(amount) == pence
+
+
+@pytest.mark.parametrize(
+    "amount", ["", " ", "-", "+", ".", "abc", "1.2.3", "1e3"]
+)
+def test_parse_pence_rejects_non_amounts(amount):
+    with pytest.raises(ValueError):
+        main.parse_pence(amount)
+
+
+@pytest.mark.parametrize(
+    "pence, amount",
+    [(-1230, "-12.30"), (5, "0.05"), (-5, "-0.05"), (0, "0.00")],
+)
+def test_pence_to_str(pence, amount):
+    assert main.pence_to_str(pence) == amount
+
+
+def test_pence_round_trip():
+    for pence in range(-1005, 1005):
+        assert main.parse_pence(main.pence_to_str(pence)) == pence
+
+
+def transactions_between(start, end):
+    day = start
+    while day <= end:
+        yield main.Transaction(
+            day, "Acme", "ref", "CARD", 100, None, "GENERAL", ""
+        )
+        day += timedelta(days=1)
+
+
+@pytest.mark.parametrize("granularity", list(main.Granularity))
+def test_bucket_starts_match_bucket_start(granularity):
+    # Spans 1970-01-01, which the vectorised weekly buckets are offset from
+    transactions = list(
+        transactions_between(date(1969, 11, 1), date(1972, 3, 31))
+    )
+    columns = main.TransactionColumns(transactions)
+    starts = columns.bucket_starts(granularity).astype(date)
+    expected = [main.bucket_start(t.date, granularity) for t in transactions]
+    assert list(starts) == expected
+
+
+async def chunked(text, size):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def parse_streamed(text, size):
+    async def collect():
+        return [row async for row in main.iter_csv_rows(chunked(text, size))]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 4096])
+def test_iter_csv_rows_quoted_newlines(size):
+    text = (
+        "Date,Counter Party,Reference\r\n"
+        '01/01/2021,"Acme\nLtd","ref, ""quoted"""\r\n'
+        "\r\n"
+        '02/01/2021,"Two\r\nlines",plain\r\n'
+        "03/01/2021,No newline at end,x"
+    )
+    expected = [row for row in csv.reader(io.StringIO(text)) if row]
+    assert parse_streamed(text, size) == expected
+    assert expected[1][1] == "Acme\nLtd"
+
+
+def test_empty_download_has_no_rows():
+    statement = main.parseStatementCSV("")
+    assert statement.rows() == []
+    assert main.statementCSVtoJson(statement) == []
+    assert main.calculateCashflow(statement)["statement"] == []
+
+
+def test_statement_rows_are_returned_as_downloaded():
+    text = (
+        "Date,Counter Party,Reference,Type,Amount (GBP),Balance (GBP)\r\n"
+        "01/01/2021,Acme,ref,CARD,50,\"1,000.00\",GENERAL,\r\n"
+        "Pending,Acme,ref,CARD,-1.00\r\n"
+        "02/01/2021,Acme,ref,CARD,-12.5,987.50,GENERAL,\r\n"
+    )
+    statement = main.parseStatementCSV(text)
+    rows = list(csv.reader(io.StringIO(text)))
+    assert statement.rows() == rows
+    assert statement.redacted(main.MASKED).rows() == [
+        main.MASKED.row(row) for row in rows
+    ]
+    assert [row["date"] for row in main.statementCSVtoJson(statement)] == [
+        "Date",
+        "01/01/2021",
+        "Pending",
+        "02/01/2021",
+    ]
+    # The unparseable row is only left out of the totals
+    cashflow = main.calculateCashflow(statement)
+    assert cashflow["credit-count"] + cashflow["debit-count"] == 2
+    assert cashflow["cashflow"] == 37.5
@@ -0,0 +1,111 @@
+"""Statement redaction and the detail password"""
+import pytest
+from fastapi import HTTPException
+
+import main
+
+HEADER = list(main.STATEMENT_HEADER)
+STATEMENT_CSV = (
+    ",".join(HEADER) + "\r\n"
+    "01/01/2021,Acme Ltd,Invoice 42,CARD,-12.30,87.70,GENERAL,Lunch\r\n"
+    "02/01/2021,Bob,Rent,FASTER PAYMENT,500.00,587.70,INCOME,\r\n"
+)
+
+
+@pytest.fixture
+def password(monkeypatch):
+    monkeypatch.setattr(main, "DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD", "pw")
+    return "pw"
+
+
+def test_redaction_for_password(password):
+    assert main.redaction_for(password) is main.FULL_DETAIL
+
+
+@pytest.mark.parametrize("attempt", [None, "", "wrong", "pw ", "PW"])
+def test_redaction_for_masks_without_the_password(password, attempt):
+    assert main.redaction_for(attempt) is main.MASKED
+
+
+@pytest.mark.parametrize("setting", [None, ""])
+@pytest.mark.parametrize("attempt", [None, ""])
+def test_redaction_for_masks_while_unset(monkeypatch, setting, attempt):
+    monkeypatch.setattr(
+        main, "DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD", setting
+    )
+    assert main.redaction_for(attempt) is main.MASKED
+
+
+MASKED_COLUMNS = (1, 2, 7)
+
+
+def test_masked_apply():
+    statement = main.parseStatementCSV(STATEMENT_CSV)
+    rows = statement.rows()
+    masked = main.MASKED.apply(statement)
+    for row, masked_row in zip(rows, masked.rows()):
+        for i, cell in enumerate(masked_row):
+            assert cell == ("#" if i in MASKED_COLUMNS else row[i])
+    for transaction in masked.transactions:
+        assert transaction.counterparty == "#"
+        assert transaction.reference == "#"
+        assert transaction.notes == "#"
+    assert [t.amount for t in masked.transactions] == [-1230, 50000]
+    # The shared, cached statement is left as it was
+    assert statement.rows() == rows
+    assert rows[1][1:3] == ["Acme Ltd", "Invoice 42"]
+
+
+def test_masked_transaction():
+    transaction = main.parseStatementCSV(STATEMENT_CSV).transactions[0]
+    masked = main.MASKED.transaction(transaction)
+    assert masked.counterparty == masked.reference == masked.notes == "#"
+    assert masked.to_row() == [
+        "01/01/2021",
+        "#",
+        "#",
+        "CARD",
+        "-12.30",
+        "87.70",
+        "GENERAL",
+        "#",
+    ]
+    assert transaction.counterparty == "Acme Ltd"
+
+
+def test_full_detail_leaves_the_statement_as_is():
+    statement = main.parseStatementCSV(STATEMENT_CSV)
+    assert main.FULL_DETAIL.apply(statement) is statement
+    assert main.FULL_DETAIL.row(HEADER) is HEADER
+
+
+def test_require_privilege_forbids_without_the_password(password):
+    with pytest.raises(HTTPException) as raised:
+        main.require_privilege("wrong", "refresh")
+    assert raised.value.status_code == 403
+    with pytest.raises(HTTPException):
+        main.require_privilege(None, "refresh")
+
+
+def test_require_privilege_forbids_while_unset(monkeypatch):
+    monkeypatch.setattr(main, "DISPLAY_FULL_STATEMENT_DETAIL_PASSWORD", None)
+    with pytest.raises(HTTPException) as raised:
+        main.require_privilege(None, "refresh")
+    assert raised.value.status_code == 403
+
+
+def test_require_privilege_allows_the_password(password):
+    main.require_privilege(password, "refresh")
+
+
+def test_redacted_views_never_reveal_detail():
+    statement = main.parseStatementCSV(STATEMENT_CSV)
+    # A privileged caller first, so nothing masked has been built yet
+    assert statement.redacted(main.FULL_DETAIL) is statement
+    masked = statement.redacted(main.MASKED)
+    assert masked is not statement
+    assert all(row[1] == "#" for row in masked.rows())
+    assert statement.redacted(main.MASKED) is masked
+    # Having built the masked view doesn't change what either caller gets
+    assert statement.redacted(main.FULL_DETAIL) is statement
+    assert statement.rows()[1][1] == "Acme Ltd"
@@ -0,0 +1,110 @@
+"""Coalescing concurrent fetches with SingleFlight"""
+import asyncio
+
+import main
+
+
+class Fetch:
+    """Counts calls, each waits until released then returns or raises"""
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.released = None
+
+    async def __call__(self):
+        self.calls += 1
+        await self.released.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_concurrent_callers_share_one_fetch():
+    async def scenario():
+        flights = main.SingleFlight()
+        fetch = Fetch(result=["statement"])
+        fetch.released = asyncio.Event()
+        callers = [
+            asyncio.ensure_future(flights.do("key", fetch)) for _ in range(5)
+        ]
+        await asyncio.sleep(0)
+        fetch.released.set()
+        results = await asyncio.gather(*callers)
+        return fetch.calls, results, flights.inflight
+
+    calls, results, inflight = run(scenario())
+    assert calls == 1
+    assert results == [["statement"]] * 5
+    assert all(result is results[0] for result in results)
+    assert inflight == {}
+
+
+def test_different_keys_fetch_separately():
+    async def scenario():
+        flights = main.SingleFlight()
+        fetch = Fetch(result=1)
+        fetch.released = asyncio.Event()
+        fetch.released.set()
+        await asyncio.gather(flights.do("a", fetch), flights.do("b", fetch))
+        return fetch.calls
+
+    assert run(scenario()) == 2
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    async def scenario():
+        flights = main.SingleFlight()
+        fetch = Fetch(error=main.StarlingError("Status:503"))
+        fetch.released = asyncio.Event()
+        callers = [
+            asyncio.ensure_future(flights.do("key", fetch)) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        fetch.released.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+
+        # The failure isn't cached, the next call fetches again
+        fetch.error = None
+        fetch.result = "recovered"
+        retried = await flights.do("key", fetch)
+        return fetch.calls, results, retried
+
+    calls, results, retried = run(scenario())
+    assert all(isinstance(e, main.StarlingError) for e in results)
+    assert retried == "recovered"
+    assert calls == 2
+
+
+def test_a_cancelled_caller_leaves_the_others_waiting():
+    async def scenario():
+        flights = main.SingleFlight()
+        fetch = Fetch(result="statement")
+        fetch.released = asyncio.Event()
+        first = asyncio.ensure_future(flights.do("key", fetch))
+        second = asyncio.ensure_future(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        fetch.released.set()
+        return fetch.calls, await second, first.cancelled()
+
+    assert run(scenario()) == (1, "statement", True)
+
+
+def test_later_calls_fetch_again():
+    async def scenario():
+        flights = main.SingleFlight()
+        fetch = Fetch(result="statement")
+        fetch.released = asyncio.Event()
+        fetch.released.set()
+        await flights.do("key", fetch)
+        await flights.do("key", fetch)
+        return fetch.calls
+
+    assert run(scenario()) == 2